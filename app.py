@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import os
 
 # --- STYLE INJECTION ---
@@ -98,6 +99,102 @@ def load_and_clean_data():
     master = pd.concat(list_of_dfs, ignore_index=True)
     return master
 
+# --- COUNTY COLUMN LOOKUP ---
+# We want the one that is definitely the County Name (usually Column J)
+# and NOT the Municipality/Library Name (Column C)
+def find_county_col(df):
+    for c in df.columns:
+        c_upper = c.upper()
+        # We want 'County' but NOT 'Code', 'Municipality', or 'Library'
+        if "COUNTY" in c_upper and "CODE" not in c_upper and "MUNICIPAL" not in c_upper:
+            return c
+    return None
+
+# --- WIDE-FORMAT METRIC CUBE ---
+# Pivots the long master table ONCE into a (library x year x metric) numeric array.
+# Multi-library / multi-metric / multi-year views slice this array instead of
+# re-filtering master_df and re-pivoting on every rerun.
+# NOTE: cache_resource hands every rerun the same array instead of unpickling a
+# fresh copy, so the cube is made read-only. The leading underscore tells Streamlit
+# not to hash the (large) dataframe; the cache is keyed on the library column name.
+@st.cache_resource
+def build_metric_cube(_df, lib_col):
+    # Rows without a library name can't be placed in the cube
+    _df = _df.dropna(subset=[lib_col])
+
+    # Each (library, year) slot holds exactly one row -- refuse to silently overwrite
+    dupes = _df[_df.duplicated([lib_col, 'Data_Year'], keep=False)]
+    if not dupes.empty:
+        pairs = sorted(set(zip(dupes[lib_col], dupes['Data_Year'])))
+        raise ValueError(f"Library reported more than once in the same year: {pairs}")
+
+    # 1. Candidate metrics: everything except identifiers like ZIPs, codes, phones and board terms
+    id_markers = ["ZIP", "CODE", "PHONE", "TERM EXPIRES", "DISTRICT", "YEAR BUILT", "YEAR LAST"]
+    metric_cols = [
+        c for c in _df.columns
+        if c not in ['Data_Year', lib_col] and not any(m in c.upper() for m in id_markers)
+    ]
+
+    # 2. Coerce every candidate to numbers in one pass and keep only the columns
+    # where (nearly) every reported value is a number -- a stray "14" in a
+    # Name or Email column doesn't make it a metric
+    numeric = _df[metric_cols].apply(pd.to_numeric, errors='coerce')
+    numeric_count = numeric.notna().sum()
+    is_metric = ((numeric_count > 0) & (numeric_count >= 0.9 * _df[metric_cols].notna().sum())).to_numpy()
+    metrics = [c for c, keep in zip(metric_cols, is_metric) if keep]
+    values = numeric.loc[:, is_metric].to_numpy(dtype=float)
+
+    # 3. Map every row to its (library, year) slot
+    libs = sorted(_df[lib_col].unique())
+    years = sorted(_df['Data_Year'].unique())
+    lib_idx = pd.Index(libs).get_indexer(_df[lib_col])
+    year_idx = pd.Index(years).get_indexer(_df['Data_Year'])
+
+    # 4. Scatter the rows into the cube; library/year combos that were never reported stay NaN
+    cube = np.full((len(libs), len(years), len(metrics)), np.nan)
+    cube[lib_idx, year_idx] = values
+    cube.flags.writeable = False
+    return libs, years, metrics, cube
+
+# Percentage columns are stored as fractions and named either "... Percentage"
+# or "% of ..." depending on the survey year
+def is_percentage(metric):
+    return "PERCENTAGE" in metric.upper() or metric.strip().startswith("%")
+
+# Percentages are already ratios and population divided by itself is just 1,
+# so per-capita mode leaves those metrics as reported
+def scales_with_population(metric, pop_col):
+    return metric != pop_col and not is_percentage(metric)
+
+def slice_metric_cube(cube, libs, years, metrics, sel_libs, sel_years, sel_metrics, per_capita_col=None):
+    # Look up every label; get_indexer gives -1 for unknown ones, which numpy
+    # would silently read as "the last row", so refuse them instead
+    positions = []
+    for axis_labels, selected in [(libs, sel_libs), (years, sel_years), (metrics, sel_metrics)]:
+        idx = pd.Index(axis_labels).get_indexer(selected)
+        if (idx == -1).any():
+            missing = [label for label, i in zip(selected, idx) if i == -1]
+            raise KeyError(f"Not found in metric cube: {missing}")
+        positions.append(idx)
+    li, yi, mi = positions
+
+    # Fancy-index the requested block out of the cube: shape (libraries, years, metrics)
+    block = cube[np.ix_(li, yi, mi)]
+
+    # Per-capita: divide each count/amount metric by that library's population for the same year
+    if per_capita_col is not None:
+        pop = cube[np.ix_(li, yi, [metrics.index(per_capita_col)])]
+        scaled = np.array([scales_with_population(m, per_capita_col) for m in sel_metrics])
+        block = np.where(scaled, block / np.where(pop > 0, pop, np.nan), block)
+
+    # Flatten to wide format: one row per library, one column per (metric, year)
+    wide_cols = pd.MultiIndex.from_product([sel_metrics, sel_years], names=['Metric', 'Data_Year'])
+    return pd.DataFrame(
+        block.transpose(0, 2, 1).reshape(len(li), -1),
+        index=pd.Index(sel_libs, name="Library"),
+        columns=wide_cols,
+    )
+
 try:
     master_df = load_and_clean_data()
     
@@ -111,7 +208,7 @@ try:
     master_df = master_df[~master_df[target_col].isin(['0', '0.0', 'nan', 'None'])]
     
     # (Existing County logic...)
-    county_col = next((c for c in master_df.columns if "COUNTY" in c.upper() and "CODE" not in c.upper()), None)
+    county_col = find_county_col(master_df)
     
     # --- TARGETING YOUR SPECIFIC COLUMN ---
     target_col = "Municipality/County"
@@ -125,7 +222,7 @@ try:
 
     st.title("📚 NJ Public Library Data Explorer")
 
-    tab1, tab2, tab3, tab4, tab5 = st.tabs(["Snapshot", "History", "Compare", "Rank", "Data Discovery"])
+    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["Snapshot", "History", "Compare", "Rank", "Data Discovery", "Trends Matrix"])
 
     with tab1:
         # 1. Selection UI
@@ -319,15 +416,7 @@ with tab3:
         st.header("📊 Library Benchmarking")
         
         # --- 1. IDENTIFY THE ACTUAL COUNTY COLUMN ---
-        # We want the one that is definitely the County Name (usually Column J)
-        # and NOT the Municipality/Library Name (Column C)
-        county_col = None
-        for c in master_df.columns:
-            c_upper = c.upper()
-            # We want 'County' but NOT 'Code', 'Municipality', or 'Library'
-            if "COUNTY" in c_upper and "CODE" not in c_upper and "MUNICIPAL" not in c_upper:
-                county_col = c
-                break
+        county_col = find_county_col(master_df)
         
         # 2. Selection UI
         c0, c1, c2, c3 = st.columns([1.5, 2.5, 1, 2])
@@ -614,6 +703,159 @@ with tab5:
                 mime="text/csv"
             )
 
+with tab6:
+        st.header("🧮 Multi-Year Trends Matrix")
+        st.write("Compare many libraries across many metrics and every year at once. Leave the library box empty to benchmark every library in the county (or the whole state).")
+
+        # 1. Build (or reuse) the pre-pivoted library x year x metric cube
+        # A data problem (e.g. a library reported twice in one year) disables this tab only
+        try:
+            cube_libs, cube_years, cube_metrics, metric_cube = build_metric_cube(master_df, target_col)
+        except ValueError as e:
+            st.error(f"The Trends Matrix is unavailable: {e}")
+            metric_cube = None
+
+        if metric_cube is not None:
+            # Population column used for per-capita figures (e.g. "2. Population")
+            pop_col = next((c for c in cube_metrics if c.upper().endswith("POPULATION")), None)
+
+            # 2. Selection UI
+            c0, c1, c2 = st.columns([1.5, 2.5, 3])
+
+            county_col_matrix = find_county_col(master_df)
+            if county_col_matrix:
+                counties_matrix = sorted([str(c) for c in master_df[county_col_matrix].unique() if pd.notnull(c) and str(c) not in ['0', '0.0', 'nan']])
+                selected_county_matrix = c0.selectbox("Filter by County", ["All Counties"] + counties_matrix, key="matrix_county")
+            else:
+                selected_county_matrix = "All Counties"
+
+            if selected_county_matrix != "All Counties":
+                pool_libs = sorted(master_df[master_df[county_col_matrix] == selected_county_matrix][target_col].dropna().unique())
+            else:
+                pool_libs = cube_libs
+
+            selected_libs_matrix = c1.multiselect(
+                "Select Libraries",
+                pool_libs,
+                key="matrix_libs",
+                placeholder="All libraries in selection"
+            )
+
+            selected_metrics_matrix = c2.multiselect(
+                "Select Data Points",
+                cube_metrics,
+                key="matrix_metrics",
+                placeholder="Choose A Metric"
+            )
+
+            c3, c4 = st.columns([3, 1.5])
+            start_year, end_year_matrix = c3.select_slider(
+                "Year Range",
+                options=cube_years,
+                value=(cube_years[0], cube_years[-1]),
+                key="matrix_years"
+            )
+            per_capita = c4.checkbox(
+                "Per capita (÷ population served)",
+                key="matrix_per_capita",
+                disabled=pop_col is None
+            )
+
+            # --- THE GATEKEEPER ---
+            if len(selected_metrics_matrix) > 0:
+                matrix_years = cube_years[cube_years.index(start_year) : cube_years.index(end_year_matrix) + 1]
+                matrix_libs = selected_libs_matrix if selected_libs_matrix else pool_libs
+
+                # 3. One vectorized slice serves every table and chart below
+                wide_df = slice_metric_cube(
+                    metric_cube, cube_libs, cube_years, cube_metrics,
+                    matrix_libs, matrix_years, selected_metrics_matrix,
+                    per_capita_col=pop_col if per_capita else None
+                )
+
+                # --- PER-METRIC FORMATTING ---
+                # Percentages are stored as fractions (0.18 -> 18%), per-capita figures need decimals
+                def format_matrix_value(metric, val):
+                    if pd.isna(val):
+                        return "N/A"
+                    if is_percentage(metric):
+                        p_val = val * 100 if 0 < abs(val) < 1 else val
+                        if round(p_val, 4) % 1 == 0:
+                            return f"{int(round(p_val))}%"
+                        return f"{p_val:.2f}%"
+                    if per_capita and scales_with_population(metric, pop_col):
+                        return f"{val:,.2f}"
+                    return f"{val:,.0f}"
+
+                # --- SUMMARY: MEDIAN ACROSS THE SELECTED LIBRARIES ---
+                st.subheader(f"📐 Median Across {len(matrix_libs)} Libraries" + (" (Per Capita)" if per_capita else ""))
+                median_table = wide_df.median().unstack('Data_Year').reindex(selected_metrics_matrix)
+                st.table(median_table.apply(lambda row: row.map(lambda x: format_matrix_value(row.name, x)), axis=1))
+
+                # --- CHART: ONE PANEL PER METRIC (only for a hand-picked set of libraries) ---
+                if selected_libs_matrix:
+                    st.divider()
+                    st.subheader("📈 Visual Trends")
+
+                    import altair as alt
+                    for i, metric in enumerate(selected_metrics_matrix):
+                        # Long format straight from the wide block (no melt needed)
+                        metric_block = wide_df[metric]
+                        chart_df_matrix = pd.DataFrame({
+                            "Library": np.repeat(metric_block.index.to_numpy(), len(matrix_years)),
+                            "Data_Year": np.tile(np.array(matrix_years, dtype=int), len(metric_block)),
+                            "Value": metric_block.to_numpy().ravel(),
+                        }).dropna(subset=["Value"])
+
+                        st.markdown(f"**Metric_{i+1}: {metric}**")
+                        trend_chart = alt.Chart(chart_df_matrix).mark_line(point=True).encode(
+                            x=alt.X('Data_Year:O', axis=alt.Axis(title='Year', labelFontSize=14, titleFontSize=16)),
+                            y=alt.Y('Value:Q', axis=alt.Axis(title='Per Capita' if per_capita and scales_with_population(metric, pop_col) else ('Percentage' if is_percentage(metric) else 'Value'), labelFontSize=14, titleFontSize=16)),
+                            color='Library:N',
+                            tooltip=['Library', 'Data_Year', 'Value']
+                        ).properties(width='container', height=350)
+
+                        st.altair_chart(trend_chart, use_container_width=True)
+
+                # --- FULL WIDE TABLE + EXPORT ---
+                st.divider()
+                st.subheader("📋 Library Detail")
+
+                # Flatten the (metric, year) columns so the table and CSV stay readable
+                export_df = wide_df.copy()
+                export_df.columns = [f"{metric} ({year})" for metric, year in export_df.columns]
+
+                # Format whole columns at once (no per-cell Python formatter) so the
+                # statewide table stays fast with hundreds of thousands of cells
+                display_matrix = export_df.copy()
+                matrix_column_config = {}
+                for flat, (metric, _) in zip(export_df.columns, wide_df.columns):
+                    if is_percentage(metric):
+                        # Same rule as the other tabs: fractions (0.18) become 18%, whole numbers stay as-is
+                        pct_vals = display_matrix[flat]
+                        display_matrix[flat] = pct_vals.where(pct_vals.abs() >= 1, pct_vals * 100)
+                        matrix_column_config[flat] = st.column_config.NumberColumn(format="%.2f%%")
+                    elif per_capita and scales_with_population(metric, pop_col):
+                        matrix_column_config[flat] = st.column_config.NumberColumn(format="%,.2f")
+                    else:
+                        matrix_column_config[flat] = st.column_config.NumberColumn(format="%,.0f")
+
+                st.dataframe(
+                    display_matrix,
+                    column_config=matrix_column_config,
+                    use_container_width=True
+                )
+
+                st.download_button(
+                    label="📥 Download Trends Matrix (CSV)",
+                    data=export_df.to_csv().encode('utf-8'),
+                    file_name=f"nj_library_trends_{start_year}_{end_year_matrix}{'_per_capita' if per_capita else ''}.csv",
+                    mime="text/csv",
+                    key="matrix_download"
+                )
+            else:
+                st.info("Select at least one data point to build the trends matrix.")
+
             # --- ABOUT THIS APP MODAL ---
 @st.dialog("About This App")
 def show_about_page():
@@ -643,6 +885,7 @@ def show_about_page():
         - **Benchmarking:** Side-by-side comparison of different municipalities.
         - **Ranking:** Statewide rankings across various metrics.
         - **Data Discovery:** Search and export functionality for the entire dataset.
+        - **Trends Matrix:** Many libraries, many metrics and every year side by side, with optional per-capita figures.
     """)
     if st.button("Close"):
         st.rerun()